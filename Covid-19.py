@@ -7,6 +7,74 @@
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ###Run Modes###
+# MAGIC 
+# MAGIC The flags below turn on the optional parts of the notebook. With every flag set to False the notebook runs the batch analysis exactly as described in the writeup.
+# MAGIC 
+# MAGIC * streaming_mode - runs the Streaming Mode section at the end of the notebook, which adds new daily csv drops incrementally instead of rerunning the whole notebook
+# MAGIC * plan_lint_mode - records oversized show/collect calls while the notebook runs and runs the Query Plan Lint section, which checks the physical plan of every named dataframe and view
+# MAGIC * plan_lint_fail_on_new - with plan_lint_mode on, fails the run if the lint finds anything that is not in the saved baseline
+# MAGIC * compact_storage_mode - stores the parquet tables and cached views with the narrowest column types that keep every value, see the Compact Storage Profile in the Data Cleansing section
+# MAGIC * incremental_training_mode - solves lr and lr2 from per-date sums that are stored between runs, so a retrain only reads the dates it hasn't seen yet, see Incremental Training in the machine learning section
+# MAGIC * approximate_mode - answers the county level exploratory averages from a stratified sample with confidence intervals, see Approximate Exploration in the Exploratory Analysis section. The exact queries stay the ones used for the final results
+
+# COMMAND ----------
+
+streaming_mode = False
+plan_lint_mode = False
+plan_lint_fail_on_new = False
+compact_storage_mode = False
+incremental_training_mode = False
+approximate_mode = False
+
+# COMMAND ----------
+
+# DBTITLE 1,Recording oversized show and collect calls for the plan lint
+from pyspark.sql import DataFrame
+
+# any show above this many rows gets reported by the lint
+plan_lint_max_show_rows = 1000
+plan_lint_collects = []
+
+def dataframe_name(df):
+    names = [name for name, value in globals().items() if value is df and not name.startswith("_")]
+    return names[0] if names else "<unnamed>"
+
+def has_row_limit(df):
+    return "GlobalLimit" in df._jdf.queryExecution().optimizedPlan().toString()
+
+def internal_collect(df):
+    # collects of small bookkeeping tables inside the notebook's own helpers, these are not reported by the lint
+    return getattr(DataFrame, "_unlinted_collect", DataFrame.collect)(df)
+
+if not plan_lint_mode and hasattr(DataFrame, "_unlinted_show"):
+    # the methods stay patched for the whole python session, so turning the flag off has to put the originals back
+    DataFrame.show = DataFrame._unlinted_show
+    DataFrame.collect = DataFrame._unlinted_collect
+    del DataFrame._unlinted_show
+    del DataFrame._unlinted_collect
+
+if plan_lint_mode and not hasattr(DataFrame, "_unlinted_show"):
+    # keep the original methods on the class so rerunning this cell doesn't wrap them twice
+    DataFrame._unlinted_show = DataFrame.show
+    DataFrame._unlinted_collect = DataFrame.collect
+
+    def linted_show(self, n=20, truncate=True, vertical=False):
+        if n > plan_lint_max_show_rows:
+            plan_lint_collects.append((dataframe_name(self), "show(%d)" % n))
+        return self._unlinted_show(n, truncate, vertical)
+
+    def linted_collect(self):
+        if not has_row_limit(self):
+            plan_lint_collects.append((dataframe_name(self), "collect() without a limit"))
+        return self._unlinted_collect()
+
+    DataFrame.show = linted_show
+    DataFrame.collect = linted_collect
+
+# COMMAND ----------
+
 # DBTITLE 0,Identifying Environment
 # MAGIC %sh
 # MAGIC pwd
@@ -226,6 +294,89 @@ key_social_distancing_df.show(3)
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ###Compact Storage Profile###
+# MAGIC 
+# MAGIC All of the measures are read in as doubles and the indexes as 32-bit ints, which takes more room than the data needs in every parquet table and cached view. When compact_storage_mode is on, each table is checked once right before it gets written or cached, and every numeric column is stored in the narrowest type that keeps all of its values:
+# MAGIC 
+# MAGIC * doubles that only hold whole numbers, like confirmed_cases and fatalities, become integers
+# MAGIC * other doubles, like m50 and mobility_change, become floats if every value still reads back the same to compact_float_decimals decimal places
+# MAGIC * integers, like m50_index and samples, become the smallest integer type that fits their range
+# MAGIC 
+# MAGIC The state, county and restriction labels stay strings because parquet and the in-memory cache both dictionary encode repeated strings by default. The Compact Storage Report near the end of the notebook compares the disk and memory size of each table with and without the profile.
+
+# COMMAND ----------
+
+from pyspark.sql import functions as F
+from pyspark.sql.types import ByteType, ShortType, LongType, FloatType
+
+# the csvs have at most this many decimal places, so floats only need to match the doubles up to here
+compact_float_decimals = 3
+
+# the numeric types every column was read in with, the report casts back to these to size the tables without the profile
+source_numeric_types = {field.name: field.dataType for schema in [cases_and_deaths_schema, community_mobility_change_us_schema, dl_us_mobility_daterow_schema, social_distancing_by_state_schema, key_social_distancing_schema] for field in schema.fields if field.dataType not in [StringType(), DateType()]}
+# cases is confirmed_cases renamed in the machine learning section
+source_numeric_types["cases"] = DoubleType()
+
+# (table, storage, compacted columns, column types before the profile, dataframe after the profile)
+storage_profile_tables = []
+
+def integer_type_for(low, high):
+    for int_type, limit in [(ByteType(), 2**7), (ShortType(), 2**15), (IntegerType(), 2**31)]:
+        if -limit <= low and high < limit:
+            return int_type
+    return LongType()
+
+def compact_types(df):
+    # one aggregation over the table gets the range of every numeric column, and for doubles how many values aren't whole numbers or don't survive a float
+    checks = []
+    for field in df.schema.fields:
+        c = F.col(field.name)
+        if isinstance(field.dataType, (DoubleType, IntegerType, LongType)):
+            checks += [F.min(c).alias(field.name + "__min"), F.max(c).alias(field.name + "__max")]
+        if isinstance(field.dataType, DoubleType):
+            checks.append(F.sum(F.when(c != F.floor(c), 1).otherwise(0)).alias(field.name + "__fraction"))
+            checks.append(F.sum(F.when(F.round(c.cast("float").cast("double"), compact_float_decimals) != c, 1).otherwise(0)).alias(field.name + "__float"))
+    if not checks:
+        return {}
+    stats = df.agg(*checks).first()
+
+    types = {}
+    for field in df.schema.fields:
+        if not isinstance(field.dataType, (DoubleType, IntegerType, LongType)) or stats[field.name + "__min"] is None:
+            continue
+        low, high = stats[field.name + "__min"], stats[field.name + "__max"]
+        if isinstance(field.dataType, DoubleType):
+            if stats[field.name + "__fraction"] == 0 and -2**63 <= low and high < 2**63:
+                new_type = integer_type_for(low, high)
+            elif stats[field.name + "__float"] == 0:
+                new_type = FloatType()
+            else:
+                continue
+        else:
+            new_type = integer_type_for(low, high)
+        if new_type != field.dataType:
+            types[field.name] = new_type
+    return types
+
+def apply_storage_profile(df, name, storage):
+    types = compact_types(df)
+    compact_df = df.select([F.col(field.name).cast(types[field.name]).alias(field.name) if field.name in types else F.col(field.name) for field in df.schema.fields])
+    compacted_columns = ", ".join("%s %s" % (column, new_type.simpleString()) for column, new_type in types.items())
+    pre_profile_types = {field.name: field.dataType for field in df.schema.fields}
+    storage_profile_tables.append((name, storage, compacted_columns, pre_profile_types, compact_df))
+    return compact_df
+
+def save_parquet(df, path):
+    if compact_storage_mode:
+        df = apply_storage_profile(df, path, "parquet")
+    df.write.save(path, format="parquet")
+
+def cache_compact(df, name):
+    return apply_storage_profile(df, name, "cache").cache()
+
+# COMMAND ----------
+
 dbutils.fs.rm("project3_spark/social_distancing_by_state.parquet", True)
 dbutils.fs.rm("project3_spark/key_social_distancing.parquet", True)
 dbutils.fs.rm("project3_spark/dl_us_mobility_daterow.parquet", True)
@@ -238,11 +389,11 @@ dbutils.fs.rm("project3_spark/community_mobility_change_us.parquet", True)
 
 # COMMAND ----------
 
-social_distancing_by_state_df.select("*").write.save("project3_spark/social_distancing_by_state.parquet", format="parquet")
-key_social_distancing_df.select("*").write.save("project3_spark/key_social_distancing.parquet", format="parquet")
-dl_us_mobility_daterow_df.select("*").write.save("project3_spark/dl_us_mobility_daterow.parquet", format="parquet")
-cases_and_deaths_df.select("*").write.save("project3_spark/cases_and_deaths.parquet", format="parquet")
-community_mobility_change_us_df.select("*").write.save("project3_spark/community_mobility_change_us.parquet", format="parquet")
+save_parquet(social_distancing_by_state_df, "project3_spark/social_distancing_by_state.parquet")
+save_parquet(key_social_distancing_df, "project3_spark/key_social_distancing.parquet")
+save_parquet(dl_us_mobility_daterow_df, "project3_spark/dl_us_mobility_daterow.parquet")
+save_parquet(cases_and_deaths_df, "project3_spark/cases_and_deaths.parquet")
+save_parquet(community_mobility_change_us_df, "project3_spark/community_mobility_change_us.parquet")
 
 # COMMAND ----------
 
@@ -285,11 +436,11 @@ key_social_distancing_cleanse_df = key_social_distancing_df
 
 # COMMAND ----------
 
-community_mobility_cleanse_df.select("*").write.save("project3_spark/community_mobility_cleanse.parquet", format="parquet")
-dl_mobility_cleanse_df.select("*").write.save("project3_spark/dl_mobility_cleanse.parquet", format="parquet")
-cases_and_deaths_cleanse_df.select("*").write.save("project3_spark/cases_and_deaths_cleanse.parquet", format="parquet")
-social_distancing_by_state_cleanse_df.select("*").write.save("project3_spark/social_distancing_by_state_cleanse.parquet", format="parquet")
-key_social_distancing_cleanse_df.select("*").write.save("project3_spark/key_social_distancing_cleanse.parquet", format="parquet")
+save_parquet(community_mobility_cleanse_df, "project3_spark/community_mobility_cleanse.parquet")
+save_parquet(dl_mobility_cleanse_df, "project3_spark/dl_mobility_cleanse.parquet")
+save_parquet(cases_and_deaths_cleanse_df, "project3_spark/cases_and_deaths_cleanse.parquet")
+save_parquet(social_distancing_by_state_cleanse_df, "project3_spark/social_distancing_by_state_cleanse.parquet")
+save_parquet(key_social_distancing_cleanse_df, "project3_spark/key_social_distancing_cleanse.parquet")
 
 # COMMAND ----------
 
@@ -300,6 +451,16 @@ key_social_distancing_cleanse_df.select("*").write.save("project3_spark/key_soci
 
 # COMMAND ----------
 
+# the cleansed tables are read by nearly every join below, so in compact mode they are cached with the compact profile
+if compact_storage_mode:
+    community_mobility_cleanse_df = cache_compact(community_mobility_cleanse_df, "community_mobility")
+    dl_mobility_cleanse_df = cache_compact(dl_mobility_cleanse_df, "dl_mobility")
+    cases_and_deaths_cleanse_df = cache_compact(cases_and_deaths_cleanse_df, "cases_and_deaths")
+    social_distancing_by_state_cleanse_df = cache_compact(social_distancing_by_state_cleanse_df, "social_distancing")
+    key_social_distancing_cleanse_df = cache_compact(key_social_distancing_cleanse_df, "key_social_distancing")
+
+# COMMAND ----------
+
 community_mobility_cleanse_df.createOrReplaceTempView("community_mobility")
 dl_mobility_cleanse_df.createOrReplaceTempView("dl_mobility")
 cases_and_deaths_cleanse_df.createOrReplaceTempView("cases_and_deaths")
@@ -531,6 +692,144 @@ temp_county_pop_df.show(3)
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ###Approximate Exploration###
+# MAGIC 
+# MAGIC The group bys over temp_county_pop_df below scan every county-day row, which gets slow for trying things out once several years of data are loaded. When approximate_mode is on, the cells in this section answer the same questions (mobility_type_change_df, mobility_m50_df and their statewide rollups) from a stratified sample instead. The exact cells after this section are still what the final results use.
+# MAGIC 
+# MAGIC The sample is stratified by state and mobility type and saved as a parquet table, so it only gets rebuilt when the budget changes or the data is reloaded. There are two budgets to pick from:
+# MAGIC 
+# MAGIC * approximate_stratum_relative_error - each state and mobility type stratum gets enough rows for its whole-stratum average mobility_change to be within this fraction of the true value at 95% confidence. This is a budget for the strata, not for the county averages the tables report: a county only has a share of its stratum's rows, so its interval is wider
+# MAGIC * approximate_max_sample_rows - caps the total size of the sample, which bounds how long the queries take. If the error budget needs more rows than this, every stratum is scaled down and the confidence intervals get wider
+# MAGIC 
+# MAGIC Every average comes with a _ci column, the half width of its 95% confidence interval. After the mobility_change tables are built, their intervals are checked against approximate_stratum_relative_error and a note is printed with how many averages are wider than it. The interval is left empty when a group only has one sampled row in a stratum, since there is no spread to estimate it from. Counties that get no rows in the sample drop out of the county tables, so the statewide rollups have a missing_groups column with how many groups they are averaging without, and a note is printed when any are missing. The same pass that builds the sample also keeps a HyperLogLog sketch of the counties in each stratum, which gives the distinct county count per state and the county and mobility type groups the rollups are compared against. The m50 quartiles come from approximate percentiles over the sample.
+
+# COMMAND ----------
+
+approximate_stratum_relative_error = 0.05
+approximate_max_sample_rows = 200000
+approximate_z = 1.96
+approximate_sample_path = "project3_spark/temp_county_pop_sample.parquet"
+approximate_strata_path = "project3_spark/temp_county_pop_strata.parquet"
+
+def build_stratified_sample():
+    # one pass over the full table gets the size, spread and county sketches of every stratum, the m50 sketch leaves out the same outlier county as the m50 queries
+    strata = spark.sql("""SELECT concat_ws('|', state, mobility_type) AS stratum, state, count(*) AS stratum_rows, avg(mobility_change) AS stratum_mean, stddev_samp(mobility_change) AS stratum_std, hll_sketch_agg(county) AS county_sketch, hll_sketch_agg(CASE WHEN county NOT LIKE 'Pocahontas County' THEN county END) AS m50_county_sketch FROM temp_county_pop_df GROUP BY state, mobility_type""").cache()
+
+    sample_rows = {}
+    for row in internal_collect(strata.select("stratum", "stratum_rows", "stratum_mean", "stratum_std")):
+        if not row.stratum_std or not row.stratum_mean:
+            needed = row.stratum_rows
+        else:
+            needed = (approximate_z * row.stratum_std / (approximate_stratum_relative_error * abs(row.stratum_mean))) ** 2
+        # finite population correction, small strata need close to all of their rows
+        sample_rows[row.stratum] = (needed / (1 + needed / row.stratum_rows), row.stratum_rows)
+    scale = min(1.0, approximate_max_sample_rows / max(sum(rows for rows, _ in sample_rows.values()), 1))
+    fractions = {stratum: min(1.0, rows * scale / stratum_rows) for stratum, (rows, stratum_rows) in sample_rows.items()}
+
+    fractions_df = spark.createDataFrame(list(fractions.items()), "stratum string, sample_fraction double")
+    strata.join(fractions_df, "stratum").withColumn("stratum_relative_error", F.lit(approximate_stratum_relative_error)).withColumn("max_sample_rows", F.lit(approximate_max_sample_rows)).\
+    write.mode("overwrite").save(approximate_strata_path, format="parquet")
+    temp_county_pop_df.withColumn("stratum", F.concat_ws("|", "state", "mobility_type")).\
+    sampleBy("stratum", fractions, seed=42).join(F.broadcast(fractions_df), "stratum").\
+    write.mode("overwrite").save(approximate_sample_path, format="parquet")
+    strata.unpersist()
+
+def sum_or_null(term):
+    # a single unknown term makes the whole interval unknown, instead of sum quietly skipping it
+    return F.when(F.count(F.when(term.isNull(), 1)) > 0, F.lit(None)).otherwise(F.sum(term))
+
+def approximate_avg(sample_df, group_cols, averages):
+    # stratified estimate of each average: the strata in a group are weighted by how many rows they stand for, and their variances give the confidence interval
+    per_stratum = sample_df.groupBy(*group_cols, "stratum", "sample_fraction").agg(F.count(F.lit(1)).alias("n"),
+        *[agg for name, column in averages.items() for agg in [F.avg(column).alias(name + "_mean"), F.var_samp(column).alias(name + "_var")]]).\
+    withColumn("weight", F.col("n") / F.col("sample_fraction"))
+    return per_stratum.groupBy(*group_cols).agg(*[agg for name in averages for agg in [
+        (F.sum(F.col("weight") * F.col(name + "_mean")) / F.sum("weight")).alias(name),
+        # strata that were fully sampled add no error, otherwise a stratum with a single sampled row has no variance and leaves the interval null
+        (approximate_z * F.sqrt(sum_or_null(F.when(F.col("sample_fraction") >= 1, F.lit(0.0)).otherwise(F.col("weight") ** 2 * (1 - F.col("sample_fraction")) * F.col(name + "_var") / F.col("n")))) / F.sum("weight")).alias(name + "_ci")]])
+
+def rollup_avg(df, group_cols, averages):
+    # average of group estimates, their errors are independent so the interval adds up in quadrature
+    return df.groupBy(*group_cols).agg(F.count(F.lit(1)).alias("sampled_groups"), *[agg for name, column in averages.items() for agg in [
+        F.avg(column).alias(name),
+        (F.sqrt(sum_or_null(F.col(column + "_ci") ** 2)) / F.count(column)).alias(name + "_ci")]])
+
+def report_error_budget(df, column, description):
+    # the budget only sizes the strata, so say how many of the reported averages ended up outside it
+    within = F.col(column + "_ci") <= approximate_stratum_relative_error * F.abs(F.col(column))
+    counts = df.agg(F.count(F.lit(1)).alias("total"), F.count(F.when(~within | within.isNull(), 1)).alias("over")).first()
+    if counts.over > 0:
+        print("%s: %d of %d %s averages have a 95%% interval wider than approximate_stratum_relative_error (%g) or none at all" %
+              (description, counts.over, counts.total, column, approximate_stratum_relative_error))
+
+def report_missing_groups(rollup_df, description):
+    # groups with no sampled rows drop out of the rollup, so it averages over fewer groups than the exact query does
+    missing = rollup_df.agg(F.sum("missing_groups")).first()[0] or 0
+    if missing > 0:
+        print("%s is missing about %d groups that had no rows in the sample, see the missing_groups column" % (description, missing))
+
+# COMMAND ----------
+
+# DBTITLE 1,Building or reusing the stratified sample
+if approximate_mode:
+    try:
+        dbutils.fs.ls(approximate_strata_path)
+        budget = spark.read.parquet(approximate_strata_path).select("stratum_relative_error", "max_sample_rows").first()
+        rebuild = budget.stratum_relative_error != approximate_stratum_relative_error or budget.max_sample_rows != approximate_max_sample_rows
+    except Exception:
+        rebuild = True
+    if rebuild:
+        build_stratified_sample()
+
+    temp_county_pop_sample_df = spark.read.parquet(approximate_sample_path)
+    approximate_strata_df = spark.read.parquet(approximate_strata_path)
+    print("sample has %d rows" % temp_county_pop_sample_df.count())
+
+# COMMAND ----------
+
+if approximate_mode:
+    approx_mobility_type_change_df = approximate_avg(temp_county_pop_sample_df, ["state", "county", "mobility_type", "current_restrictions"],
+        {"mobility_change": "mobility_change", "average_cases": "cases_density", "average_fatalities": "fatality_density"})
+    approx_mobility_type_change_df.orderBy("state", "county", "mobility_type").show(8)
+    report_error_budget(approx_mobility_type_change_df, "mobility_change", "approx_mobility_type_change_df")
+
+    # the county sketches from every mobility type of a state merge into one distinct count
+    # each stratum is one mobility type, so the county and mobility type groups of a state are the sum of its per-stratum estimates
+    approx_state_counties_df = approximate_strata_df.groupBy("state").agg(F.expr("hll_sketch_estimate(hll_union_agg(county_sketch))").alias("approx_counties"),
+        F.sum(F.expr("hll_sketch_estimate(county_sketch)")).alias("county_mobility_groups"),
+        F.expr("hll_sketch_estimate(hll_union_agg(m50_county_sketch))").alias("m50_counties"))
+
+    approx_statewide_mobility_type_df = rollup_avg(approx_mobility_type_change_df, ["state", "current_restrictions"],
+        {"state_avg_mobility_change": "mobility_change", "state_avg_cases": "average_cases", "state_avg_fatalities": "average_fatalities"}).\
+    join(approx_state_counties_df, "state", "left").\
+    withColumn("missing_groups", F.greatest(F.col("county_mobility_groups") - F.col("sampled_groups"), F.lit(0)))
+    approx_statewide_mobility_type_df.orderBy("state_avg_mobility_change").show(3, False)
+    report_error_budget(approx_statewide_mobility_type_df, "state_avg_mobility_change", "approx_statewide_mobility_type_df")
+    # the group counts are HyperLogLog estimates, so the missing count is approximate too
+    report_missing_groups(approx_statewide_mobility_type_df, "approx_statewide_mobility_type_df")
+
+# COMMAND ----------
+
+if approximate_mode:
+    # same outlier removal as the exact m50 query
+    approx_mobility_m50_df = approximate_avg(temp_county_pop_sample_df.where("county NOT LIKE 'Pocahontas County'"), ["state", "county", "current_restrictions"],
+        {"avg_m50": "m50", "avg_m50_index": "m50_index", "average_cases": "cases_density", "average_fatalities": "fatality_density"})
+
+    # m50 is the same for every mobility type of a county-day, so the sample rows don't need weights for its quartiles
+    approx_m50_quartiles_df = temp_county_pop_sample_df.where("county NOT LIKE 'Pocahontas County'").groupBy("state").\
+    agg(F.expr("percentile_approx(m50, array(0.25, 0.5, 0.75))").alias("m50_quartiles"))
+
+    approx_statewide_m50_df = rollup_avg(approx_mobility_m50_df, ["state", "current_restrictions"],
+        {"state_avg_m50": "avg_m50", "state_avg_m50_index": "avg_m50_index", "state_avg_cases": "average_cases", "state_avg_fatalities": "average_fatalities"}).\
+    join(approx_m50_quartiles_df, "state", "left").join(approx_state_counties_df, "state", "left").\
+    withColumn("missing_groups", F.greatest(F.col("m50_counties") - F.col("sampled_groups"), F.lit(0)))
+    approx_statewide_m50_df.orderBy("state_avg_m50_index").show(3, False) # change show value from 3 to 51 to see every state
+    # the county count here is the HyperLogLog estimate, so the missing count is approximate too
+    report_missing_groups(approx_statewide_m50_df, "approx_statewide_m50_df")
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC The "temp_pop_df" and "temp_county_pop_df" will be used for several problems. The first of which we will explore is on mobility_type and mobility_change. We will then do an analysis on the m50 and m50_index. After that we will look at the entire combined dataset and see what trends we can find with the social distancing restrictions, mobility, and the cases. 
 
@@ -619,10 +918,14 @@ interested_cols_ML.show(3)
 # COMMAND ----------
 
 # turning string categorical variables back into integers
-lblIndxr = StringIndexer().setInputCol("religious_restrictions").setOutputCol("label_religious_rest") 
-idxRes = lblIndxr.fit(interested_cols_ML).transform(interested_cols_ML)
-lblIndxr2 = StringIndexer().setInputCol("current_restrictions").setOutputCol("label_curr_rest") 
-idxRes2 = lblIndxr2.fit(idxRes).transform(idxRes)
+# the default order is by frequency, which can reshuffle as days are added, incremental_training_mode needs indexes that stay put
+label_order = "alphabetAsc" if incremental_training_mode else "frequencyDesc"
+lblIndxr = StringIndexer().setInputCol("religious_restrictions").setOutputCol("label_religious_rest").setStringOrderType(label_order)
+lblIndxrModel = lblIndxr.fit(interested_cols_ML)
+idxRes = lblIndxrModel.transform(interested_cols_ML)
+lblIndxr2 = StringIndexer().setInputCol("current_restrictions").setOutputCol("label_curr_rest").setStringOrderType(label_order)
+lblIndxrModel2 = lblIndxr2.fit(idxRes)
+idxRes2 = lblIndxrModel2.transform(idxRes)
 # tried using for loop, ended up taking just as long
 # indexers = [StringIndexer(inputCol=column, outputCol=column+"_label").fit(interested_cols_ML).transform(interested_cols_ML) for column in interested_cols_ML.columns if "_restrictions" in column ]
 
@@ -639,7 +942,8 @@ dbutils.fs.rm("project3_spark/final_ml_df.parquet", True)
 
 # COMMAND ----------
 
-final_cols_df.select("*").write.save("project3_spark/final_ml_df.parquet", format="parquet")
+# with incremental training on, the rows are laid out by date inside each file so its date filter can skip row groups
+save_parquet(final_cols_df.sortWithinPartitions("date") if incremental_training_mode else final_cols_df, "project3_spark/final_ml_df.parquet")
 
 # COMMAND ----------
 
@@ -689,33 +993,253 @@ vtest_final.show(3)
 from pyspark.ml.regression import LinearRegression
 # performing the linear regression training
 lr = LinearRegression(featuresCol = 'features', labelCol='cases', maxIter=10, regParam=0.3, elasticNetParam=0.8)
-lr_model = lr.fit(vtrain_final)
-print("Coefficients: " + str(lr_model.coefficients))
-print("Intercept: " + str(lr_model.intercept))
+# in incremental_training_mode lr is solved from the stored per-date sums below instead of rescanning the training history
+if not incremental_training_mode:
+    lr_model = lr.fit(vtrain_final)
+    print("Coefficients: " + str(lr_model.coefficients))
+    print("Intercept: " + str(lr_model.intercept))
 
 # COMMAND ----------
 
-trainingSummary = lr_model.summary
-print("RMSE: %f" % trainingSummary.rootMeanSquaredError)
-print("r2: %f" % trainingSummary.r2)
-
-# COMMAND ----------
-
-vtrain_final.describe().show()
+# MAGIC %md
+# MAGIC ###Incremental Training###
+# MAGIC 
+# MAGIC Every time lr and lr2 are retrained they rescan the whole training history, and that history grows every day. A linear regression only needs a few sums from the data though: the row count, the sums of the features and the label, X<sup>T</sup>X and X<sup>T</sup>y. The means and variances of the features come from those sums as well. When incremental_training_mode is on, these sums are kept per date for each feature set in a parquet table outside of project3_spark, so they survive the cleanup at the start of the notebook. A run only reads and computes the sums for dates after the last one in the table, then adds up the per-date sums and solves the model from them on the driver.
+# MAGIC 
+# MAGIC The solve uses the same objective as LinearRegression with standardization: the features and label are standardized, and the elastic net penalty is applied with regParam and elasticNetParam from lr. Coordinate descent starts from the coefficients of the previous run when they were fitted with the same labels, so a day of new data usually only takes a few sweeps. In this mode the StringIndexers order the restriction labels alphabetically rather than by frequency, so the indexes don't move as new days shift the counts. The per-date sums are stored with the StringIndexer labels too, because a different label order would change what the restriction columns mean. If a new label does appear, the stored sums for that feature set are deleted and every date is recomputed once.
+# MAGIC 
+# MAGIC In this mode the two LinearRegression fits, their training summaries and the describe() of the training sets are skipped, since each of them scans the whole history. The training RMSE and r2 and the column statistics come from the same sums, and the evaluation cells below score the test sets with the incrementally solved coefficients.
+
+# COMMAND ----------
+
+import numpy as np
+from pyspark.ml.functions import vector_to_array
+
+incremental_stats_path = "dbfs:/project3_models/regression_stats.parquet"
+incremental_coefficients_path = "dbfs:/project3_models/regression_coefficients.parquet"
+incremental_feature_sets = {"lr": ['m50', 'm50_index', 'label_religious_rest', 'label_curr_rest'],
+                            "lr2": ['m50', 'm50_index', 'label_religious_rest', 'label_curr_rest', 'cases', 'fatalities']}
+incremental_label = "cases"
+# coordinate descent stops once no coefficient moves more than this in a sweep
+incremental_tolerance = 1e-9
+incremental_max_sweeps = 1000
+
+def date_stats(df, feature_set, feature_cols, indexer_labels):
+    # one pass over the rows gives every sum the model needs, grouped by date so each day can be stored on its own
+    xs = [F.col(c).cast("double") for c in feature_cols]
+    y = F.col(incremental_label).cast("double")
+    return df.dropna(subset=feature_cols + [incremental_label]).groupBy("date").agg(
+        F.count(F.lit(1)).alias("n"),
+        F.array(*[F.sum(x) for x in xs]).alias("x_sum"),
+        F.sum(y).alias("y_sum"),
+        F.sum(y * y).alias("y_sq_sum"),
+        F.array(*[F.sum(xi * xj) for xi in xs for xj in xs]).alias("xtx"),
+        F.array(*[F.sum(x * y) for x in xs]).alias("xty")).\
+    withColumn("feature_set", F.lit(feature_set)).withColumn("indexer_labels", F.lit(indexer_labels))
+
+def solve_elastic_net(stats, reg_param, elastic_net_param, previous_coefficients=None):
+    k = len(stats["x_sum"])
+    n = stats["n"]
+    x_mean = np.array(stats["x_sum"]) / n
+    y_mean = stats["y_sum"] / n
+    xtx = np.array(stats["xtx"]).reshape(k, k)
+    x_cov = xtx / n - np.outer(x_mean, x_mean)
+    xy_cov = np.array(stats["xty"]) / n - x_mean * y_mean
+    # LinearRegression standardizes with the sample standard deviations (n - 1), while its loss averages over n
+    y_std = np.sqrt(max(stats["y_sq_sum"] / n - y_mean ** 2, 0.0) * n / max(n - 1, 1))
+    x_std = np.sqrt(np.clip(np.diag(x_cov), 0.0, None) * n / max(n - 1, 1))
+    if y_std == 0:
+        return np.zeros(k), y_mean
+
+    # covariances of the standardized features and label, constant features are left at a coefficient of zero
+    varying = x_std > 0
+    scale = np.where(varying, x_std, 1.0)
+    gram = x_cov / np.outer(scale, scale)
+    corr = xy_cov / (scale * y_std)
+    # LinearRegression divides regParam by the label's standard deviation when it standardizes the label
+    l1 = elastic_net_param * reg_param / y_std
+    l2 = (1 - elastic_net_param) * reg_param / y_std
+
+    beta = np.zeros(k) if previous_coefficients is None else np.array(previous_coefficients) * scale / y_std
+    beta[~varying] = 0.0
+    for sweep in range(incremental_max_sweeps):
+        largest_change = 0.0
+        for j in np.nonzero(varying)[0]:
+            z = corr[j] - gram[j].dot(beta) + gram[j, j] * beta[j]
+            new_beta = np.sign(z) * max(abs(z) - l1, 0.0) / (gram[j, j] + l2)
+            largest_change = max(largest_change, abs(new_beta - beta[j]))
+            beta[j] = new_beta
+        if largest_change < incremental_tolerance:
+            break
+
+    coefficients = beta * y_std / scale
+    return coefficients, y_mean - coefficients.dot(x_mean)
+
+def training_fit(stats, coefficients, intercept):
+    # the squared error of the fit can be expanded into the same sums, so RMSE and r2 don't need another pass over the data
+    k = len(coefficients)
+    n = stats["n"]
+    xtx = np.array(stats["xtx"]).reshape(k, k)
+    sse = stats["y_sq_sum"] - 2 * coefficients.dot(stats["xty"]) - 2 * intercept * stats["y_sum"] + \
+        coefficients.dot(xtx).dot(coefficients) + 2 * intercept * coefficients.dot(stats["x_sum"]) + n * intercept ** 2
+    sst = stats["y_sq_sum"] - stats["y_sum"] ** 2 / n
+    return np.sqrt(max(sse, 0.0) / n), 1 - sse / sst
+
+def incremental_describe(feature_set):
+    # count, mean and sample standard deviation of the training columns from the stored sums, in place of describe() on the whole history
+    stats = incremental_totals[feature_set]
+    n = stats["n"]
+    k = len(stats["x_sum"])
+    sums = list(stats["x_sum"]) + [stats["y_sum"]]
+    squares = [stats["xtx"][i * k + i] for i in range(k)] + [stats["y_sq_sum"]]
+    spark.createDataFrame([(column, n, total / n, float(np.sqrt(max(square - total * total / n, 0.0) / max(n - 1, 1))))
+                           for column, total, square in zip(incremental_feature_sets[feature_set] + [incremental_label], sums, squares)],
+                          "column string, count long, mean double, stddev double").show()
+
+def incremental_transform(feature_set, df):
+    # scores the assembled feature vector with the incrementally solved coefficients, like LinearRegressionModel.transform
+    coefficients, intercept = incremental_models[feature_set]
+    features = vector_to_array(F.col("features"))
+    prediction = F.lit(float(intercept))
+    for i, coefficient in enumerate(coefficients):
+        prediction = prediction + features[i] * float(coefficient)
+    return df.withColumn("prediction", prediction)
+
+# COMMAND ----------
+
+# DBTITLE 1,Adding the sums for new dates and solving lr and lr2 from them
+if incremental_training_mode:
+    indexer_labels = ",".join(lblIndxrModel.labels) + "|" + ",".join(lblIndxrModel2.labels)
+
+    try:
+        dbutils.fs.ls(incremental_coefficients_path)
+        # coefficients fitted with a different label order mean something else, so they are no use as a warm start
+        previous_coefficients = {row.feature_set: row.coefficients for row in internal_collect(spark.read.parquet(incremental_coefficients_path))
+                                 if row.asDict().get("indexer_labels") == indexer_labels}
+    except Exception:
+        previous_coefficients = {}
+
+    incremental_models = {}
+    incremental_totals = {}
+    for feature_set, feature_cols in incremental_feature_sets.items():
+        feature_set_path = incremental_stats_path + "/feature_set=" + feature_set
+        try:
+            dbutils.fs.ls(feature_set_path)
+            stored_stats_df = spark.read.parquet(incremental_stats_path).where(F.col("feature_set") == feature_set)
+        except Exception:
+            stored_stats_df = None
+
+        new_dates_df = train_final_ml_df
+        if stored_stats_df is not None:
+            last_stored = stored_stats_df.agg(F.max("date").alias("date"), F.max(F.col("indexer_labels") != indexer_labels).alias("stale")).first()
+            if last_stored.stale:
+                # a new restriction label moved the indexes, so the sums stored under the old labels are replaced rather than kept beside the new ones
+                dbutils.fs.rm(feature_set_path, True)
+            elif last_stored.date is not None:
+                # days arrive in order, so a range filter past the last stored date finds the new ones and lets parquet skip everything older
+                new_dates_df = train_final_ml_df.where(F.col("date") > F.lit(last_stored.date))
+        date_stats(new_dates_df, feature_set, feature_cols, indexer_labels).write.partitionBy("feature_set", "date").mode("append").save(incremental_stats_path, format="parquet")
+
+        # adding up the per-date sums only touches one small row per date
+        k = len(feature_cols)
+        totals = spark.read.parquet(incremental_stats_path).\
+        where((F.col("feature_set") == feature_set) & (F.col("indexer_labels") == indexer_labels)).\
+        agg(F.sum("n").alias("n"),
+            F.array(*[F.sum(F.col("x_sum")[i]) for i in range(k)]).alias("x_sum"),
+            F.sum("y_sum").alias("y_sum"),
+            F.sum("y_sq_sum").alias("y_sq_sum"),
+            F.array(*[F.sum(F.col("xtx")[i]) for i in range(k * k)]).alias("xtx"),
+            F.array(*[F.sum(F.col("xty")[i]) for i in range(k)]).alias("xty")).first().asDict()
+
+        coefficients, intercept = solve_elastic_net(totals, lr.getRegParam(), lr.getElasticNetParam(), previous_coefficients.get(feature_set))
+        rmse, r2 = training_fit(totals, coefficients, intercept)
+        incremental_models[feature_set] = (coefficients, intercept)
+        incremental_totals[feature_set] = totals
+        print("%s Coefficients: %s" % (feature_set, list(coefficients)))
+        print("%s Intercept: %s" % (feature_set, intercept))
+        print("%s RMSE: %f r2: %f on %d training rows" % (feature_set, rmse, r2, totals["n"]))
+
+    spark.createDataFrame([(feature_set, [float(c) for c in coefficients], float(intercept), indexer_labels) for feature_set, (coefficients, intercept) in incremental_models.items()],
+                          "feature_set string, coefficients array<double>, intercept double, indexer_labels string").\
+    write.mode("overwrite").save(incremental_coefficients_path, format="parquet")
+
+# COMMAND ----------
+
+if not incremental_training_mode:
+    trainingSummary = lr_model.summary
+    print("RMSE: %f" % trainingSummary.rootMeanSquaredError)
+    print("r2: %f" % trainingSummary.r2)
+
+# COMMAND ----------
+
+if incremental_training_mode:
+    incremental_describe("lr")
+else:
+    vtrain_final.describe().show()
 
 # COMMAND ----------
 
-lr_predictions = lr_model.transform(vtest_final)
+# MAGIC %md
+# MAGIC ###Model Evaluation###
+# MAGIC 
+# MAGIC Every transform, evaluator and display on the test set used to score it again. Instead, each model's test set is scored once and the predictions are cached. A single aggregation over the cached predictions then computes everything below:
+# MAGIC 
+# MAGIC * RMSE, R<sup>2</sup> and MAE
+# MAGIC * residual quantiles
+# MAGIC * a binned fitted vs residual histogram
+# MAGIC 
+# MAGIC The fitted values and residuals range from a few cases to hundreds of thousands, so the histogram bins are on a log scale on both sides of zero. Each bin covers evaluation_bins_per_decade of a power of ten. Every evaluation is appended as one row per model to a metrics table outside of project3_spark, tagged with the time of the run.
+
+# COMMAND ----------
+
+import math
+from datetime import datetime
+
+evaluation_metrics_path = "dbfs:/project3_models/evaluation_metrics.parquet"
+evaluation_run = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+evaluation_bins_per_decade = 4
+evaluation_quantiles = [0.0, 0.05, 0.25, 0.5, 0.75, 0.95, 1.0]
+
+def evaluate_predictions(model_name, predictions, label="cases"):
+    predictions = predictions.cache()
+    predictions.createOrReplaceTempView("evaluation_predictions")
+    # the empty grouping set gives the metrics for the whole test set in the same pass that fills the histogram bins
+    # the error metrics only read rows of the empty grouping set (grouping_id() = 3), so the bins just count and don't each build a quantile digest
+    # the label is cast to double first, an integer label (compact_storage_mode) would overflow in label * label
+    rows = internal_collect(spark.sql("""WITH labeled AS (SELECT prediction, CAST({label} AS DOUBLE) AS label FROM evaluation_predictions),
+    residuals AS (SELECT prediction, label, label - prediction AS residual FROM labeled),
+    binned AS (SELECT *, signum(prediction) * floor(log10(1 + abs(prediction)) * {bins}) AS fitted_bin, signum(residual) * floor(log10(1 + abs(residual)) * {bins}) AS residual_bin FROM residuals)
+    SELECT grouping_id() AS grouping_level, fitted_bin, residual_bin, count(*) AS n,
+    sqrt(avg(CASE WHEN grouping_id() = 3 THEN residual * residual END)) AS rmse, avg(CASE WHEN grouping_id() = 3 THEN abs(residual) END) AS mae,
+    1 - sum(CASE WHEN grouping_id() = 3 THEN residual * residual END) / (sum(CASE WHEN grouping_id() = 3 THEN label * label END) - sum(CASE WHEN grouping_id() = 3 THEN label END) * sum(CASE WHEN grouping_id() = 3 THEN label END) / count(*)) AS r2,
+    percentile_approx(CASE WHEN grouping_id() = 3 THEN residual END, array({quantiles})) AS residual_quantiles
+    FROM binned GROUP BY GROUPING SETS ((fitted_bin, residual_bin), ())""".format(label=label, bins=evaluation_bins_per_decade, quantiles=", ".join(str(q) for q in evaluation_quantiles))))
+
+    # an empty test set has no rows at all, not even the one for the empty grouping set
+    overall = next((row for row in rows if row.grouping_level == 3), None)
+    n, rmse, r2, mae, residual_quantiles = (overall.n, overall.rmse, overall.r2, overall.mae, overall.residual_quantiles) if overall else (0, None, None, None, None)
+    histogram = [(row.fitted_bin, row.residual_bin, row.n) for row in rows if row.grouping_level == 0]
+    metrics = spark.createDataFrame([(evaluation_run, model_name, n, rmse, r2, mae, residual_quantiles, histogram)],
+                                    "run string, model string, n long, rmse double, r2 double, mae double, residual_quantiles array<double>, fitted_vs_residuals array<struct<fitted_bin:double,residual_bin:double,count:long>>")
+    metrics.write.mode("append").save(evaluation_metrics_path, format="parquet")
+    if n == 0:
+        print("%s has no test rows to evaluate" % model_name)
+    else:
+        print("%s on test data: RMSE = %s, R Squared (R2) = %s, MAE = %s" % (model_name, rmse, r2, mae))
+        print("%s residual quantiles %s: %s" % (model_name, evaluation_quantiles, residual_quantiles))
+    return predictions, metrics.first()
+
+def bin_start(log_bin):
+    return math.copysign(10 ** (abs(log_bin) / evaluation_bins_per_decade) - 1, log_bin)
+
+def fitted_vs_residuals_df(metrics):
+    # turns the log bins back into the fitted value and residual each bin starts at, for plotting
+    return spark.createDataFrame([(bin_start(b.fitted_bin), bin_start(b.residual_bin), b["count"]) for b in metrics.fitted_vs_residuals], "fitted double, residual double, count long")
+
+# COMMAND ----------
+
+lr_predictions, lr_metrics = evaluate_predictions("lr", incremental_transform("lr", vtest_final) if incremental_training_mode else lr_model.transform(vtest_final))
 lr_predictions.select("prediction","cases","features").show(50)
-from pyspark.ml.evaluation import RegressionEvaluator
-lr_evaluator = RegressionEvaluator(predictionCol="prediction", \
-                 labelCol="cases",metricName="r2")
-print("R Squared (R2) on test data = %g" % lr_evaluator.evaluate(lr_predictions))
-
-# COMMAND ----------
-
-test_result = lr_model.evaluate(vtest_final)
-print("Root Mean Squared Error (RMSE) on test data = %g" % test_result.rootMeanSquaredError)
 
 # COMMAND ----------
 
@@ -740,50 +1264,326 @@ vtest_final2.show(3)
 # COMMAND ----------
 
 lr2 = LinearRegression(featuresCol = 'features', labelCol='cases', maxIter=10, regParam=0.3, elasticNetParam=0.8)
-lr_model2 = lr.fit(vtrain_final2)
-print("Coefficients: " + str(lr_model2.coefficients))
-print("Intercept: " + str(lr_model2.intercept))
+if not incremental_training_mode:
+    lr_model2 = lr.fit(vtrain_final2)
+    print("Coefficients: " + str(lr_model2.coefficients))
+    print("Intercept: " + str(lr_model2.intercept))
+
+# COMMAND ----------
+
+if not incremental_training_mode:
+    trainingSummary2 = lr_model2.summary
+    print("RMSE: %f" % trainingSummary2.rootMeanSquaredError)
+    print("r2: %f" % trainingSummary2.r2)
+
+# COMMAND ----------
+
+if incremental_training_mode:
+    incremental_describe("lr2")
+else:
+    vtrain_final2.describe().show()
 
 # COMMAND ----------
 
-trainingSummary2 = lr_model2.summary
-print("RMSE: %f" % trainingSummary2.rootMeanSquaredError)
-print("r2: %f" % trainingSummary2.r2)
+lr_predictions2, lr_metrics2 = evaluate_predictions("lr2", incremental_transform("lr2", vtest_final2) if incremental_training_mode else lr_model2.transform(vtest_final2))
+lr_predictions2.select("prediction","cases","features").show(50)
 
 # COMMAND ----------
 
-vtrain_final2.describe().show()
+display(lr_predictions2)
 
 # COMMAND ----------
 
-lr_predictions2 = lr_model2.transform(vtest_final2)
-lr_predictions2.select("prediction","cases","features").show(10)
-from pyspark.ml.evaluation import RegressionEvaluator
-lr_evaluator2 = RegressionEvaluator(predictionCol="prediction", \
-                 labelCol="cases",metricName="r2")
-print("R Squared (R2) on test data = %g" % lr_evaluator2.evaluate(lr_predictions2))
+# MAGIC %md
+# MAGIC The prediction with the second linear regression model was a very clear linear line and had a R-squared value of nearly one. Included the previous cases amounts allowed the model to correctly predicted how many cases there would be in the future, and thus this model does a great job of predicting the number of cases heading forward. It would be interesting to see if the model still performs well 2-3 weeks from now after social distancing restrictions have been eased the past 1-2 weeks.
+# MAGIC 
+# MAGIC 
+# MAGIC Below are the fitted vs residual plots for the predictions. The first prediction has fitted values that are much lower as it was underestimating the number of cases. This can also  be seen by the fact that the residuals are all positive which indicates the actual values was higher than the predicted value. The second display is for the second model that included the number of cases on previous days. The output was a lot closer as can be seen that the residual range was -150 to 100 rather than -20k to 250k (huge differene). 
 
 # COMMAND ----------
 
-predictions2 = lr_model2.transform(vtest_final2)
-predictions2.select("prediction","cases","features").show(50)
+display(fitted_vs_residuals_df(lr_metrics))
 
 # COMMAND ----------
 
-display(predictions2)
+display(fitted_vs_residuals_df(lr_metrics2))
 
 # COMMAND ----------
 
 # MAGIC %md
-# MAGIC The prediction with the second linear regression model was a very clear linear line and had a R-squared value of nearly one. Included the previous cases amounts allowed the model to correctly predicted how many cases there would be in the future, and thus this model does a great job of predicting the number of cases heading forward. It would be interesting to see if the model still performs well 2-3 weeks from now after social distancing restrictions have been eased the past 1-2 weeks.
+# MAGIC ##Compact Storage Report##
 # MAGIC 
+# MAGIC When compact_storage_mode is on, this compares every table that went through the compact profile with the same table in the types it was read in with. Parquet tables are compared by their size on disk, which means writing a scratch copy of each one, and cached views are compared by their size in memory.
+
+# COMMAND ----------
+
+def parquet_bytes(path):
+    return sum(file_info.size for file_info in dbutils.fs.ls(path))
+
+def cached_bytes(df):
+    df.cache().count()
+    # a fresh plan picks up the cached relation, whose statistics are its real size once it is materialized
+    return int(df.select("*")._jdf.queryExecution().optimizedPlan().stats().sizeInBytes().toString())
+
+def default_types(compact_df, pre_profile_types):
+    # source columns go back to the types they were read in with, since an earlier table's profile may already have narrowed them,
+    # and derived columns go back to the types they had when they reached the profile
+    numeric = (ByteType, ShortType, IntegerType, LongType, FloatType, DoubleType)
+    return compact_df.select([F.col(field.name).cast(source_numeric_types.get(field.name, pre_profile_types[field.name])).alias(field.name) if isinstance(field.dataType, numeric) else F.col(field.name) for field in compact_df.schema.fields])
+
+# COMMAND ----------
+
+if compact_storage_mode:
+    storage_report = []
+    storage_scratch_path = "project3_spark/storage_profile_scratch.parquet"
+    for name, storage, compacted_columns, pre_profile_types, compact_df in storage_profile_tables:
+        default_df = default_types(compact_df, pre_profile_types)
+        if storage == "parquet":
+            dbutils.fs.rm(storage_scratch_path, True)
+            default_df.write.save(storage_scratch_path, format="parquet")
+            default_bytes, compact_bytes = parquet_bytes(storage_scratch_path), parquet_bytes(name)
+            dbutils.fs.rm(storage_scratch_path, True)
+        else:
+            default_bytes, compact_bytes = cached_bytes(default_df), cached_bytes(compact_df)
+            default_df.unpersist()
+        storage_report.append((name, storage, compacted_columns, default_bytes, compact_bytes))
+
+    storage_report_df = spark.createDataFrame(storage_report, "table string, storage string, compacted_columns string, bytes long, compact_bytes long").\
+    withColumn("saved_percent", F.round(100 * (1 - F.col("compact_bytes") / F.col("bytes")), 1))
+    storage_report_df.show(20, False)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ##Query Plan Lint##
 # MAGIC 
-# MAGIC Below are the fitted vs residual plots for the predictions. The first prediction has fitted values that are much lower as it was underestimating the number of cases. This can also  be seen by the fact that the residuals are all positive which indicates the actual values was higher than the predicted value. The second display is for the second model that included the number of cases on previous days. The output was a lot closer as can be seen that the residual range was -150 to 100 rather than -20k to 250k (huge differene). 
+# MAGIC A few of the dataframes above sort data that only gets queried again later, like the orderBy on combined_county_df and ordered_density_social_dist and the ORDER BY inside temp_pop_df and temp_county_pop_df. Each of those forces a total sort before the next join or group by. When plan_lint_mode is on, this section goes through the physical plan of every named dataframe and temp view in the notebook and reports:
+# MAGIC 
+# MAGIC * global sorts that feed another operator instead of the output
+# MAGIC * exchanges that shuffle data again on the same keys it was already shuffled on
+# MAGIC * cartesian and non-equi (nested loop) joins
+# MAGIC * show calls over plan_lint_max_show_rows rows and collects without a limit, like combined_df.show(30000), recorded while the notebook ran
+# MAGIC 
+# MAGIC The findings are compared with a baseline saved outside of project3_spark, because that directory is wiped at the start of every run. With plan_lint_fail_on_new on, the run fails if there are findings that are not in the baseline. Otherwise the current findings become the new baseline.
+
+# COMMAND ----------
+
+import re
+
+plan_lint_baseline_path = "dbfs:/project3_lint/plan_lint_baseline.parquet"
+# operators that just pass rows through to the output, a global sort underneath them is fine
+plan_lint_output_operators = ["AdaptiveSparkPlan", "Project", "ColumnarToRow", "InputAdapter", "WholeStageCodegen"]
+
+def parse_plan(plan_string):
+    # turns the plan tree string into (depth, operator) pairs, with the expression ids removed so plans can be compared
+    nodes = []
+    for line in plan_string.split("\n"):
+        match = re.match(r"^([ :|+-]*?)(\+- |:- )?([^ :|+-].*)$", line)
+        if not match:
+            continue
+        depth = len(match.group(1)) // 3 + (0 if match.group(2) is None else 1)
+        operator = re.sub(r"^\*\(\d+\) ", "", match.group(3))
+        operator = re.sub(r", \[(id|plan_id)=[^\]]*\]", "", operator)
+        operator = re.sub(r"#\d+L?", "", operator)
+        nodes.append((depth, operator))
+    return nodes
+
+def operator_name(operator):
+    match = re.match(r"\w+", operator)
+    return match.group(0) if match else operator
+
+def lint_plan(name, df):
+    findings = []
+    ancestors = []
+    for depth, operator in parse_plan(df._jdf.queryExecution().executedPlan().toString()):
+        ancestors = ancestors[:depth]
+        op_name = operator_name(operator)
+        if op_name == "Sort" and re.search(r"\], true,", operator):
+            feeding = [operator_name(parent) for parent in ancestors if operator_name(parent) not in plan_lint_output_operators and not parent.startswith("==")]
+            # Spark puts exchanges and local sorts between the sort and the join or aggregate that actually uses it
+            consumers = [op for op in feeding if op not in ["Exchange", "Sort"]]
+            if feeding:
+                findings.append((name, "global sort", "%s feeds %s" % (operator, (consumers or feeding)[-1])))
+        if op_name == "Exchange":
+            partitioning = operator.split("), ")[0]
+            if any(parent.startswith(partitioning) for parent in ancestors):
+                findings.append((name, "repeated exchange", partitioning + ")"))
+        if op_name in ["CartesianProduct", "BroadcastNestedLoopJoin"]:
+            findings.append((name, "cartesian or non-equi join", operator))
+        ancestors.append(operator)
+    return findings
+
+# COMMAND ----------
+
+if plan_lint_mode:
+    named_frames = {name: value for name, value in globals().items() if isinstance(value, DataFrame) and not name.startswith("_")}
+    for table in spark.catalog.listTables():
+        if table.isTemporary:
+            named_frames["view " + table.name] = spark.table(table.name)
+
+    plan_lint_findings = []
+    for name, df in sorted(named_frames.items()):
+        if not df.isStreaming:
+            plan_lint_findings += lint_plan(name, df)
+    plan_lint_findings += [(name, "oversized collect", call) for name, call in plan_lint_collects]
+
+    plan_lint_df = spark.createDataFrame(plan_lint_findings, "name string, check string, detail string").distinct()
+    plan_lint_df.groupBy("check").count().show()
+    plan_lint_df.orderBy("check", "name").show(100, False)
+
+# COMMAND ----------
+
+# DBTITLE 1,Comparing the lint findings with the baseline
+if plan_lint_mode:
+    try:
+        dbutils.fs.ls(plan_lint_baseline_path)
+        plan_lint_baseline_df = spark.read.parquet(plan_lint_baseline_path)
+    except Exception:
+        # first lint run, everything found now becomes the baseline
+        plan_lint_baseline_df = plan_lint_df.limit(0)
+
+    new_plan_lint_df = plan_lint_df.join(plan_lint_baseline_df, ["name", "check", "detail"], "left_anti").cache()
+    new_plan_lint_df.show(100, False)
+
+    if new_plan_lint_df.count() > 0 and plan_lint_fail_on_new:
+        raise Exception("Query plan lint found %d new findings, see the output above" % new_plan_lint_df.count())
+    plan_lint_df.write.mode("overwrite").save(plan_lint_baseline_path, format="parquet")
 
 # COMMAND ----------
 
-display(lr_model, vtest_final, "fittedVsResiduals")
+# MAGIC %md
+# MAGIC ##Streaming Mode##
+# MAGIC 
+# MAGIC New days of cases_and_deaths.csv and DL-us-mobility-daterow.csv come out every day, and adding one day by rerunning everything above rescans the full history. This section uses structured streaming to watch a drop directory in the dbfs with one sub-directory per dataset, using the same schemas from the Schema Design section. community_mobility_change_us is left out, since the stream only keeps state level tables and that dataset is only used for the county level mobility_change tables. A new day is added by dropping its csv into the matching sub-directory, for example dbfs:/project3_stream/stream_drop/cases_and_deaths/2020-04-29.csv. Everything the stream keeps lives under dbfs:/project3_stream/ rather than project3_spark, which gets removed at the start of every full run of the notebook.
+# MAGIC 
+# MAGIC Every query keeps a checkpoint, so a rerun only reads the files it has not seen yet. The queries use an availableNow trigger, meaning a daily run processes whatever is new and then stops. The stream is built in three stages:
+# MAGIC 
+# MAGIC * cleansing - each dataset is cleansed the same way as in the Data Cleansing section and appended to its own cleansed parquet table
+# MAGIC * state-day facts - the cleansed cases and deaths are joined with the state level m50 data and the social distancing restrictions, giving one row per state and date
+# MAGIC * exploratory aggregates - the averages by restriction are kept up to date from the cleansed cases and the restrictions, and the averages by state from the state-day facts
+# MAGIC 
+# MAGIC The watermark on date lets spark throw away the dedup and join state for days older than the late data threshold, so a daily update only does work for that day's data instead of the whole history. The cases and the m50 data are both deduplicated under that watermark, so late data is handled the same way for both: a day that arrives more than stream_late_threshold behind the newest day already seen is dropped, and every query prints how many rows it dropped that way. A backfill older than that needs a full run of the notebook. To use it, set streaming_mode to True in the Run Modes cell, then run the Schema Design cells and this section.
+
+# COMMAND ----------
+
+# each dataset gets its own sub-directory under the drop, output and checkpoint directories
+stream_drop_dir = "dbfs:/project3_stream/stream_drop/"
+stream_output_dir = "dbfs:/project3_stream/stream/"
+stream_checkpoint_dir = "dbfs:/project3_stream/stream_checkpoints/"
+# how late a day of data can arrive and still be deduplicated and joined
+stream_late_threshold = "3 days"
+
+# community_mobility_change_us only feeds the county level tables, which the stream doesn't keep, so it isn't streamed
+stream_datasets = ["cases_and_deaths", "dl_us_mobility_daterow", "social_distancing_by_state", "key_social_distancing"]
+
+if streaming_mode:
+    for name in stream_datasets:
+        dbutils.fs.mkdirs(stream_drop_dir + name)
+        dbutils.fs.mkdirs(stream_output_dir + name + "_cleanse.parquet")
+    dbutils.fs.mkdirs(stream_output_dir + "state_day_facts.parquet")
+
+# COMMAND ----------
+
+from pyspark.sql.functions import col
+
+def read_drop(name, schema):
+    # the file source only picks up files that are not already in the query's checkpoint
+    return spark.readStream.format("csv").option("header","true").\
+    schema(schema).load(stream_drop_dir + name)
+
+def read_stream_table(name, schema):
+    return spark.readStream.format("parquet").schema(schema).load(stream_output_dir + name + ".parquet")
+
+def read_static_stream_table(name):
+    # the output directories are made up front, so an empty one means nothing has been dropped for that dataset yet
+    path = stream_output_dir + name + ".parquet"
+    if not any(file_info.name.endswith(".parquet") for file_info in dbutils.fs.ls(path)):
+        raise Exception("%s has no data yet, drop a %s csv into %s first" % (path, name.replace("_cleanse", ""), stream_drop_dir))
+    return spark.read.parquet(path)
+
+def with_date_watermark(df):
+    # watermarks have to be on a timestamp, so the date is cast into an event_time column
+    return df.withColumn("event_time", col("date").cast("timestamp")).withWatermark("event_time", stream_late_threshold)
+
+def report_late_rows(query, name):
+    # rows older than the watermark are dropped by the dedup and join state, so say how many a run lost instead of dropping them silently
+    late_rows = sum(operator.get("numRowsDroppedByWatermark", 0) for progress in query.recentProgress for operator in progress.get("stateOperators", []))
+    if late_rows > 0:
+        print("%s dropped %d rows that arrived more than %s late" % (name, late_rows, stream_late_threshold))
+
+def append_stream(df, name):
+    query = df.writeStream.format("parquet").outputMode("append").\
+    option("checkpointLocation", stream_checkpoint_dir + name).\
+    trigger(availableNow=True).start(stream_output_dir + name + ".parquet")
+    query.awaitTermination()
+    report_late_rows(query, name)
+    return query
+
+def overwrite_aggregate_stream(df, name):
+    # the running sums and counts live in the checkpointed state, complete mode hands each batch the whole (small) aggregate table to write out
+    query = df.writeStream.outputMode("complete").\
+    option("checkpointLocation", stream_checkpoint_dir + name).\
+    foreachBatch(lambda batch_df, batch_id: batch_df.write.mode("overwrite").save(stream_output_dir + name + ".parquet", format="parquet")).\
+    trigger(availableNow=True).start()
+    query.awaitTermination()
+    return query
+
+# COMMAND ----------
+
+# DBTITLE 1,Streaming the new drops into the cleansed parquet tables
+if streaming_mode:
+    # same filters as the batch cleansing, the DISTINCT becomes a dropDuplicates bounded by the watermark
+    # both dated datasets are deduplicated under the same watermark, so a re-dropped day is ignored and a late day is handled the same way in either
+    cases_and_deaths_cleanse_stream = with_date_watermark(read_drop("cases_and_deaths", cases_and_deaths_schema)).\
+    dropDuplicates().where("country_region LIKE 'US'").drop("event_time")
+    dl_mobility_cleanse_stream = with_date_watermark(read_drop("dl_us_mobility_daterow", dl_us_mobility_daterow_schema)).\
+    dropDuplicates().where("country_code LIKE 'US'").where("state IS NOT NULL").drop("event_time")
+    social_distancing_by_state_cleanse_stream = read_drop("social_distancing_by_state", social_distancing_by_state_schema)
+    key_social_distancing_cleanse_stream = read_drop("key_social_distancing", key_social_distancing_schema)
+
+    append_stream(cases_and_deaths_cleanse_stream, "cases_and_deaths_cleanse")
+    append_stream(dl_mobility_cleanse_stream, "dl_us_mobility_daterow_cleanse")
+    append_stream(social_distancing_by_state_cleanse_stream, "social_distancing_by_state_cleanse")
+    append_stream(key_social_distancing_cleanse_stream, "key_social_distancing_cleanse")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC The state-day facts are the same grain as the data used in the machine learning section, one row per state and date with the cases, fatalities, restrictions and state level m50 values. Cases and the m50 data are both streams, so they are joined on state and the watermarked date. The social distancing restrictions barely change, so they are read as a static table and joined onto the stream.
+
+# COMMAND ----------
+
+if streaming_mode:
+    read_static_stream_table("social_distancing_by_state_cleanse").createOrReplaceTempView("stream_social_distancing")
+    read_static_stream_table("key_social_distancing_cleanse").createOrReplaceTempView("stream_key_social_distancing")
+    spark.sql("""CREATE OR REPLACE TEMP VIEW stream_social_distance_final AS SELECT state, religious_key.religious_restrictions, current_key.current_restrictions, stay_at_home_end_date_as_of_april_28 AS restriction_end_date_of_april28, current_population FROM stream_social_distancing INNER JOIN stream_key_social_distancing religious_key ON (religious_key.key = stream_social_distancing.religious_restrictions) INNER JOIN stream_key_social_distancing current_key ON (current_key.key = stream_social_distancing.current_restriction)""")
+
+    with_date_watermark(read_stream_table("cases_and_deaths_cleanse", cases_and_deaths_schema)).createOrReplaceTempView("stream_cases_and_deaths")
+    with_date_watermark(read_stream_table("dl_us_mobility_daterow_cleanse", dl_us_mobility_daterow_schema).where("county IS NULL")).createOrReplaceTempView("stream_state_mobility")
+
+    state_day_facts_stream = spark.sql("""SELECT stream_state_mobility.state, stream_state_mobility.date, confirmed_cases, fatalities, restriction_end_date_of_april28, current_population, religious_restrictions, current_restrictions, m50, m50_index, (confirmed_cases / current_population) AS cases_density, (fatalities / current_population) AS fatality_density FROM stream_cases_and_deaths INNER JOIN stream_state_mobility ON (stream_cases_and_deaths.province_state = stream_state_mobility.state AND stream_cases_and_deaths.event_time = stream_state_mobility.event_time) INNER JOIN stream_social_distance_final ON (stream_state_mobility.state = stream_social_distance_final.state)""")
+    append_stream(state_day_facts_stream, "state_day_facts")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC The exploratory aggregates read the cleansed tables as streams as well. The averages by restriction join the cleansed cases with the restrictions, the same rows the batch social_distance_method_average_case_by_density averages over, so they don't depend on whether a state-day has m50 data. The averages by state come from the state-day facts. Spark keeps the running sum and count behind each average in the checkpoint, so each run only folds in the new state-days. The m50 averages here come from the state level rows rather than averaging the counties first like the Exploratory Analysis section does.
+
+# COMMAND ----------
+
+if streaming_mode:
+    read_stream_table("state_day_facts", state_day_facts_stream.schema).createOrReplaceTempView("stream_state_day_facts")
+
+    # like the batch table of the same name, the restriction averages are over every cases row with a restriction, not only the state-days that also have m50 data
+    read_stream_table("cases_and_deaths_cleanse", cases_and_deaths_schema).createOrReplaceTempView("stream_cleansed_cases_and_deaths")
+    stream_restriction_averages = spark.sql("""SELECT current_restrictions, avg(confirmed_cases / current_population) AS average_cases, avg(fatalities / current_population) AS average_fatalities, avg(confirmed_cases) as avg_num_cases, avg(fatalities) as avg_num_fatalities FROM stream_cleansed_cases_and_deaths INNER JOIN stream_social_distance_final ON (stream_cleansed_cases_and_deaths.province_state = stream_social_distance_final.state) WHERE current_population IS NOT NULL GROUP BY current_restrictions""")
+    overwrite_aggregate_stream(stream_restriction_averages, "social_distance_method_average_case_by_density")
+
+    stream_statewide_m50 = spark.sql("""SELECT state, avg(m50) as state_avg_m50, avg(m50_index) as state_avg_m50_index, avg(cases_density) as state_avg_cases, avg(fatality_density) as state_avg_fatalities, current_restrictions FROM stream_state_day_facts GROUP BY state, current_restrictions""")
+    overwrite_aggregate_stream(stream_statewide_m50, "statewide_m50")
 
 # COMMAND ----------
 
-display(lr_model2, vtest_final2, "fittedVsResiduals")
+if streaming_mode:
+    spark.read.parquet(stream_output_dir + "social_distance_method_average_case_by_density.parquet").orderBy("average_cases").show(7, False)
+    spark.read.parquet(stream_output_dir + "statewide_m50.parquet").orderBy("state_avg_m50_index").show(3, False) # change show value from 3 to 51 to see every state